@@ -9,12 +9,25 @@ if TYPE_CHECKING:
 
 MISSING = object()
 
+_RELEASE_RE = re.compile(r'## (\d+\.\d+\.\d+)')
+_VERSION_RE = re.compile(r'(\d+\.\d+\.\d+)')
+_FIRST_RELEASE = (1, 0, 0)
+
 
 def _parse_changelog(path):
-    raw = path.read_text()
-    managed_by_towncrier = 'towncrier release notes start' in raw
-    releases = re.findall(r'## (\d+\.\d+\.\d+)', raw)
-    latest = releases[0] if releases else MISSING
+    # The towncrier marker and the latest release are both at the top of the file,
+    # so we stop reading as soon as we find the first release heading.
+    managed_by_towncrier = False
+    latest = MISSING
+    with path.open() as f:
+        for line in f:
+            if 'towncrier release notes start' in line:
+                managed_by_towncrier = True
+                continue
+            match = _RELEASE_RE.search(line)
+            if match:
+                latest = match.group(1)
+                break
     return managed_by_towncrier, latest
 
 
@@ -30,12 +43,15 @@ def _validate_python_package(
         )
         return
 
-    latest_pkg_v = re.findall(r"(\d+\.\d+\.\d+)", version_file.read_text())[0]
+    from packaging.version import Version
+
+    latest_pkg_v = _VERSION_RE.search(version_file.read_text()).group(1)
+    is_released = Version(latest_pkg_v).release >= _FIRST_RELEASE
 
     # New integrations that are Python packages should have:
     # - autogenerated CHANGELOG that's empty
     # - version <1.0.0 in __about__.py
-    if latest_pkg_v < '1.0.0':
+    if not is_released:
         if changelog_latest_v is not MISSING:
             track_err(
                 message=(
@@ -50,7 +66,7 @@ def _validate_python_package(
 
     # Python packages that have been released should have version >=1.0.0 and at least one CHANGELOG entry.
     # The latest CHANGELOG release should match the __about__.py version.
-    if latest_pkg_v >= '1.0.0' and changelog_latest_v is MISSING:
+    if changelog_latest_v is MISSING:
         track_err(
             message=(
                 f'Getting conflicting information. Version {latest_pkg_v} from {version_file.relative_to(repo_path)} '
@@ -19,69 +19,78 @@ DEFAULT_ROW_LIMIT = 10000
 
 AGENT_HISTORY_QUERY = """\
 WITH HISTORY_ENTRIES AS (
-    SELECT {history_row_limit_filter}
-        j.name AS job_name,
-        CAST(sjh1.job_id AS char(36)) AS job_id,
+    SELECT
+        sjh1.job_id,
         sjh1.step_name,
         sjh1.step_id,
-        sjh1.instance_id AS step_instance_id,
-        (
-            SELECT MIN(sjh2.instance_id)
-            FROM msdb.dbo.sysjobhistory AS sjh2
-            WHERE sjh2.job_id = sjh1.job_id
-            AND sjh2.step_id = 0
-            AND sjh2.instance_id >= sjh1.instance_id
-        ) AS completion_instance_id,
-        (
-            SELECT DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh1.run_time / 10000,
-                    DATEADD(MINUTE, (sjh1.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh1.run_time % 100,
-                            CAST(CAST(sjh1.run_date AS CHAR(8)) AS DATETIME)
-                        )
+        sjh1.instance_id,
+        sjh1.run_date,
+        sjh1.run_time,
+        sjh1.run_duration,
+        sjh1.run_status,
+        sjh1.message,
+        MIN(CASE WHEN sjh1.step_id = 0 THEN sjh1.instance_id END) OVER (
+            PARTITION BY sjh1.job_id
+            ORDER BY sjh1.instance_id
+            ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+        ) AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh1
+),
+COMPLETED_JOBS AS (
+    SELECT sjh2.instance_id AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh2
+    WHERE sjh2.step_id = 0
+    AND (DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, sjh2.run_time / 10000,
+                DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
+                    DATEADD(SECOND, sjh2.run_time % 100,
+                        CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        ) AS run_epoch_time,
-        (
-            (sjh1.run_duration / 10000) * 3600
-            + ((sjh1.run_duration % 10000) / 100) * 60
-            + (sjh1.run_duration % 100)
-        ) AS run_duration_seconds,
-        CASE sjh1.run_status
-            WHEN 0 THEN 'Failed'
-            WHEN 1 THEN 'Succeeded'
-            WHEN 2 THEN 'Retry'
-            WHEN 3 THEN 'Canceled'
-            WHEN 4 THEN 'In Progress'
-            ELSE 'Unknown'
-        END AS step_run_status,
-        sjh1.message
-    FROM
-        msdb.dbo.sysjobhistory AS sjh1
-    INNER JOIN msdb.dbo.sysjobs AS j
-    ON j.job_id = sjh1.job_id
-    ORDER BY completion_instance_id DESC
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    + (sjh2.run_duration / 10000) * 3600
+    + ((sjh2.run_duration % 10000) / 100) * 60
+    + (sjh2.run_duration % 100)) > ?
 )
-SELECT * FROM HISTORY_ENTRIES
-WHERE
-    EXISTS (
-        SELECT 1
-        FROM msdb.dbo.sysjobhistory AS sjh2
-        WHERE sjh2.instance_id = HISTORY_ENTRIES.completion_instance_id
-        AND (DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh2.run_time / 10000,
-                    DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh2.run_time % 100,
-                            CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
-                        )
+SELECT {history_row_limit_filter}
+    j.name AS job_name,
+    CAST(he.job_id AS char(36)) AS job_id,
+    he.step_name,
+    he.step_id,
+    he.instance_id AS step_instance_id,
+    he.completion_instance_id,
+    (
+        SELECT DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, he.run_time / 10000,
+                DATEADD(MINUTE, (he.run_time / 100) % 100,
+                    DATEADD(SECOND, he.run_time % 100,
+                        CAST(CAST(he.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        + (sjh2.run_duration / 10000) * 3600
-        + ((sjh2.run_duration % 10000) / 100) * 60
-        + (sjh2.run_duration % 100)) > 0 + {last_collection_time_filter}
-    )
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    ) AS run_epoch_time,
+    (
+        (he.run_duration / 10000) * 3600
+        + ((he.run_duration % 10000) / 100) * 60
+        + (he.run_duration % 100)
+    ) AS run_duration_seconds,
+    CASE he.run_status
+        WHEN 0 THEN 'Failed'
+        WHEN 1 THEN 'Succeeded'
+        WHEN 2 THEN 'Retry'
+        WHEN 3 THEN 'Canceled'
+        WHEN 4 THEN 'In Progress'
+        ELSE 'Unknown'
+    END AS step_run_status,
+    he.message
+FROM HISTORY_ENTRIES AS he
+INNER JOIN COMPLETED_JOBS AS cj
+ON cj.completion_instance_id = he.completion_instance_id
+INNER JOIN msdb.dbo.sysjobs AS j
+ON j.job_id = he.job_id
+ORDER BY he.completion_instance_id DESC
 """
 
 
@@ -103,6 +112,9 @@ class SqlserverAgentHistory(DBMAsyncJob):
         if history_row_limit <= 0:
             history_row_limit = DEFAULT_ROW_LIMIT
         self.history_row_limit = history_row_limit
+        self._history_query = AGENT_HISTORY_QUERY.format(
+            history_row_limit_filter="TOP {history_row_limit}".format(history_row_limit=history_row_limit)
+        )
         self._last_collection_time = int(time.time())
         super(SqlserverAgentHistory, self).__init__(
             check,
@@ -125,14 +137,9 @@ class SqlserverAgentHistory(DBMAsyncJob):
 
     @tracked_method(agent_check_getter=agent_check_getter)
     def _get_new_agent_job_history(self, cursor):
-        last_collection_time_filter = "{last_collection_time}".format(last_collection_time=self._last_collection_time)
-        history_row_limit_filter = "TOP {history_row_limit}".format(history_row_limit=self.history_row_limit)
-        query = AGENT_HISTORY_QUERY.format(
-            history_row_limit_filter=history_row_limit_filter, last_collection_time_filter=last_collection_time_filter
-        )
         self.log.debug("collecting sql server agent jobs history")
-        self.log.debug("Running query [%s]", query)
-        cursor.execute(query)
+        self.log.debug("Running query [%s], %s", self._history_query, self._last_collection_time)
+        cursor.execute(self._history_query, [self._last_collection_time])
         columns = [i[0] for i in cursor.description]
         # construct row dicts manually as there's no DictCursor for pyodbc
         rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
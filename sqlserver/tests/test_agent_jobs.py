@@ -22,136 +22,154 @@ pytestmark = [pytest.mark.integration]
 
 AGENT_HISTORY_QUERY = """\
 WITH HISTORY_ENTRIES AS (
-    SELECT {history_row_limit_filter}
-        j.name AS job_name,
-        CAST(sjh1.job_id AS char(36)) AS job_id,
+    SELECT
+        sjh1.job_id,
         sjh1.step_name,
         sjh1.step_id,
-        sjh1.instance_id AS step_instance_id,
-        (
-            SELECT MIN(sjh2.instance_id)
-            FROM msdb.dbo.sysjobhistory AS sjh2
-            WHERE sjh2.job_id = sjh1.job_id
-            AND sjh2.step_id = 0
-            AND sjh2.instance_id >= sjh1.instance_id
-        ) AS completion_instance_id,
-        (
-            SELECT DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh1.run_time / 10000,
-                    DATEADD(MINUTE, (sjh1.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh1.run_time % 100,
-                            CAST(CAST(sjh1.run_date AS CHAR(8)) AS DATETIME)
-                        )
+        sjh1.instance_id,
+        sjh1.run_date,
+        sjh1.run_time,
+        sjh1.run_duration,
+        sjh1.run_status,
+        sjh1.message,
+        MIN(CASE WHEN sjh1.step_id = 0 THEN sjh1.instance_id END) OVER (
+            PARTITION BY sjh1.job_id
+            ORDER BY sjh1.instance_id
+            ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+        ) AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh1
+),
+COMPLETED_JOBS AS (
+    SELECT sjh2.instance_id AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh2
+    WHERE sjh2.step_id = 0
+    AND (DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, sjh2.run_time / 10000,
+                DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
+                    DATEADD(SECOND, sjh2.run_time % 100,
+                        CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        ) AS run_epoch_time,
-        (
-            (sjh1.run_duration / 10000) * 3600
-            + ((sjh1.run_duration % 10000) / 100) * 60
-            + (sjh1.run_duration % 100)
-        ) AS run_duration_seconds,
-        CASE sjh1.run_status
-            WHEN 0 THEN 'Failed'
-            WHEN 1 THEN 'Succeeded'
-            WHEN 2 THEN 'Retry'
-            WHEN 3 THEN 'Canceled'
-            WHEN 4 THEN 'In Progress'
-            ELSE 'Unknown'
-        END AS step_run_status,
-        sjh1.message
-    FROM
-        msdb.dbo.sysjobhistory AS sjh1
-    INNER JOIN msdb.dbo.sysjobs AS j
-    ON j.job_id = sjh1.job_id
-    ORDER BY completion_instance_id DESC
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    + (sjh2.run_duration / 10000) * 3600
+    + ((sjh2.run_duration % 10000) / 100) * 60
+    + (sjh2.run_duration % 100)) > ?
 )
-SELECT * FROM HISTORY_ENTRIES
-WHERE
-    EXISTS (
-        SELECT 1
-        FROM msdb.dbo.sysjobhistory AS sjh2
-        WHERE sjh2.instance_id = HISTORY_ENTRIES.completion_instance_id
-        AND (DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh2.run_time / 10000,
-                    DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh2.run_time % 100,
-                            CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
-                        )
+SELECT {history_row_limit_filter}
+    j.name AS job_name,
+    CAST(he.job_id AS char(36)) AS job_id,
+    he.step_name,
+    he.step_id,
+    he.instance_id AS step_instance_id,
+    he.completion_instance_id,
+    (
+        SELECT DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, he.run_time / 10000,
+                DATEADD(MINUTE, (he.run_time / 100) % 100,
+                    DATEADD(SECOND, he.run_time % 100,
+                        CAST(CAST(he.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        + (sjh2.run_duration / 10000) * 3600
-        + ((sjh2.run_duration % 10000) / 100) * 60
-        + (sjh2.run_duration % 100)) > 0 + {last_collection_time_filter}
-    )
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    ) AS run_epoch_time,
+    (
+        (he.run_duration / 10000) * 3600
+        + ((he.run_duration % 10000) / 100) * 60
+        + (he.run_duration % 100)
+    ) AS run_duration_seconds,
+    CASE he.run_status
+        WHEN 0 THEN 'Failed'
+        WHEN 1 THEN 'Succeeded'
+        WHEN 2 THEN 'Retry'
+        WHEN 3 THEN 'Canceled'
+        WHEN 4 THEN 'In Progress'
+        ELSE 'Unknown'
+    END AS step_run_status,
+    he.message
+FROM HISTORY_ENTRIES AS he
+INNER JOIN COMPLETED_JOBS AS cj
+ON cj.completion_instance_id = he.completion_instance_id
+INNER JOIN msdb.dbo.sysjobs AS j
+ON j.job_id = he.job_id
+ORDER BY he.completion_instance_id DESC
 """
 
 FORMATTED_HISTORY_QUERY = """\
 WITH HISTORY_ENTRIES AS (
-    SELECT TOP 10000
-        j.name AS job_name,
-        CAST(sjh1.job_id AS char(36)) AS job_id,
+    SELECT
+        sjh1.job_id,
         sjh1.step_name,
         sjh1.step_id,
-        sjh1.instance_id AS step_instance_id,
-        (
-            SELECT MIN(sjh2.instance_id)
-            FROM msdb.dbo.sysjobhistory AS sjh2
-            WHERE sjh2.job_id = sjh1.job_id
-            AND sjh2.step_id = 0
-            AND sjh2.instance_id >= sjh1.instance_id
-        ) AS completion_instance_id,
-        (
-            SELECT DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh1.run_time / 10000,
-                    DATEADD(MINUTE, (sjh1.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh1.run_time % 100,
-                            CAST(CAST(sjh1.run_date AS CHAR(8)) AS DATETIME)
-                        )
+        sjh1.instance_id,
+        sjh1.run_date,
+        sjh1.run_time,
+        sjh1.run_duration,
+        sjh1.run_status,
+        sjh1.message,
+        MIN(CASE WHEN sjh1.step_id = 0 THEN sjh1.instance_id END) OVER (
+            PARTITION BY sjh1.job_id
+            ORDER BY sjh1.instance_id
+            ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+        ) AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh1
+),
+COMPLETED_JOBS AS (
+    SELECT sjh2.instance_id AS completion_instance_id
+    FROM msdb.dbo.sysjobhistory AS sjh2
+    WHERE sjh2.step_id = 0
+    AND (DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, sjh2.run_time / 10000,
+                DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
+                    DATEADD(SECOND, sjh2.run_time % 100,
+                        CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        ) AS run_epoch_time,
-        (
-            (sjh1.run_duration / 10000) * 3600
-            + ((sjh1.run_duration % 10000) / 100) * 60
-            + (sjh1.run_duration % 100)
-        ) AS run_duration_seconds,
-        CASE sjh1.run_status
-            WHEN 0 THEN 'Failed'
-            WHEN 1 THEN 'Succeeded'
-            WHEN 2 THEN 'Retry'
-            WHEN 3 THEN 'Canceled'
-            WHEN 4 THEN 'In Progress'
-            ELSE 'Unknown'
-        END AS step_run_status,
-        sjh1.message
-    FROM
-        msdb.dbo.sysjobhistory AS sjh1
-    INNER JOIN msdb.dbo.sysjobs AS j
-    ON j.job_id = sjh1.job_id
-    ORDER BY completion_instance_id DESC
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    + (sjh2.run_duration / 10000) * 3600
+    + ((sjh2.run_duration % 10000) / 100) * 60
+    + (sjh2.run_duration % 100)) > ?
 )
-SELECT * FROM HISTORY_ENTRIES
-WHERE
-    EXISTS (
-        SELECT 1
-        FROM msdb.dbo.sysjobhistory AS sjh2
-        WHERE sjh2.instance_id = HISTORY_ENTRIES.completion_instance_id
-        AND (DATEDIFF(SECOND, '19700101',
-                DATEADD(HOUR, sjh2.run_time / 10000,
-                    DATEADD(MINUTE, (sjh2.run_time / 100) % 100,
-                        DATEADD(SECOND, sjh2.run_time % 100,
-                            CAST(CAST(sjh2.run_date AS CHAR(8)) AS DATETIME)
-                        )
+SELECT TOP 10000
+    j.name AS job_name,
+    CAST(he.job_id AS char(36)) AS job_id,
+    he.step_name,
+    he.step_id,
+    he.instance_id AS step_instance_id,
+    he.completion_instance_id,
+    (
+        SELECT DATEDIFF(SECOND, '19700101',
+            DATEADD(HOUR, he.run_time / 10000,
+                DATEADD(MINUTE, (he.run_time / 100) % 100,
+                    DATEADD(SECOND, he.run_time % 100,
+                        CAST(CAST(he.run_date AS CHAR(8)) AS DATETIME)
                     )
                 )
-            ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
-        + (sjh2.run_duration / 10000) * 3600
-        + ((sjh2.run_duration % 10000) / 100) * 60
-        + (sjh2.run_duration % 100)) > 0 + 10000
-    )
+            )
+        ) - DATEPART(tzoffset, SYSDATETIMEOFFSET()) * 60
+    ) AS run_epoch_time,
+    (
+        (he.run_duration / 10000) * 3600
+        + ((he.run_duration % 10000) / 100) * 60
+        + (he.run_duration % 100)
+    ) AS run_duration_seconds,
+    CASE he.run_status
+        WHEN 0 THEN 'Failed'
+        WHEN 1 THEN 'Succeeded'
+        WHEN 2 THEN 'Retry'
+        WHEN 3 THEN 'Canceled'
+        WHEN 4 THEN 'In Progress'
+        ELSE 'Unknown'
+    END AS step_run_status,
+    he.message
+FROM HISTORY_ENTRIES AS he
+INNER JOIN COMPLETED_JOBS AS cj
+ON cj.completion_instance_id = he.completion_instance_id
+INNER JOIN msdb.dbo.sysjobs AS j
+ON j.job_id = he.job_id
+ORDER BY he.completion_instance_id DESC
 """
 
 AGENT_ACTIVITY_DURATION_QUERY = """\
@@ -338,13 +356,9 @@ def test_connection_with_agent_history(instance_docker):
 
     with check.connection.open_managed_default_connection():
         with check.connection.get_managed_cursor() as cursor:
-            last_collection_time_filter = "{last_collection_time}".format(last_collection_time=10000)
             history_row_limit_filter = "TOP {history_row_limit}".format(history_row_limit=10000)
-            query = AGENT_HISTORY_QUERY.format(
-                history_row_limit_filter=history_row_limit_filter,
-                last_collection_time_filter=last_collection_time_filter,
-            )
-            cursor.execute(query)
+            query = AGENT_HISTORY_QUERY.format(history_row_limit_filter=history_row_limit_filter)
+            cursor.execute(query, [10000])
             assert query == FORMATTED_HISTORY_QUERY
 
 
@@ -400,27 +414,37 @@ def test_history_output(instance_docker, sa_conn):
     check.initialize_connection()
     with check.connection.open_managed_default_connection():
         with check.connection.get_managed_cursor() as cursor:
-            last_collection_time_filter = "{last_collection_time}".format(last_collection_time=now - 1)
             history_row_limit_filter = "TOP {history_row_limit}".format(history_row_limit=10000)
-            query = AGENT_HISTORY_QUERY.format(
-                history_row_limit_filter=history_row_limit_filter,
-                last_collection_time_filter=last_collection_time_filter,
-            )
-            cursor.execute(query)
+            query = AGENT_HISTORY_QUERY.format(history_row_limit_filter=history_row_limit_filter)
+            cursor.execute(query, [now - 1])
             results = cursor.fetchall()
             assert len(results) == 7, "should have 7 steps associated with completed jobs"
             assert len(results[0]) == 10, "should have 10 columns per step"
-            last_collection_time_filter = "{last_collection_time}".format(last_collection_time=now + 1)
+            completion_instance_ids = [row[5] for row in results]
+            assert completion_instance_ids == sorted(
+                completion_instance_ids, reverse=True
+            ), "steps should be ordered by completion_instance_id DESC"
+            for row in results:
+                step_id, step_instance_id, completion_instance_id = row[3], row[4], row[5]
+                if step_id == 0:
+                    assert completion_instance_id == step_instance_id, "job outcome row should complete itself"
+                else:
+                    assert completion_instance_id > step_instance_id, "step should map to a later job completion"
             history_row_limit_filter = "TOP {history_row_limit}".format(history_row_limit=10000)
-            query = AGENT_HISTORY_QUERY.format(
-                history_row_limit_filter=history_row_limit_filter,
-                last_collection_time_filter=last_collection_time_filter,
-            )
-            cursor.execute(query)
+            query = AGENT_HISTORY_QUERY.format(history_row_limit_filter=history_row_limit_filter)
+            cursor.execute(query, [now + 1])
             results = cursor.fetchall()
             assert (
                 len(results) == 4
             ), "should only have 4 steps associated with completed jobs when filtering with last collection time"
+            # the row limit applies to the steps of jobs completed after the last collection time,
+            # keeping the most recently completed ones
+            history_row_limit_filter = "TOP {history_row_limit}".format(history_row_limit=2)
+            query = AGENT_HISTORY_QUERY.format(history_row_limit_filter=history_row_limit_filter)
+            cursor.execute(query, [now - 1])
+            results = cursor.fetchall()
+            assert len(results) == 2, "should cap the newly completed steps at the history row limit"
+            assert [row[5] for row in results] == completion_instance_ids[:2], "should keep the newest completions"
 
 
 @pytest.mark.flaky